@@ -0,0 +1,404 @@
+"""
+Local cache for MCP tool results and Claude responses, and the MCP session
+and Claude helpers the search clients share
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import time
+from contextlib import AsyncExitStack
+from functools import cached_property
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from anthropic import AsyncAnthropic
+from anthropic.types import Message
+from mcp import ClientSession, StdioServerParameters
+from mcp.client.stdio import stdio_client
+from mcp.types import Implementation
+
+logger = logging.getLogger("gymmando")
+
+# orjson is optional; it encodes cache keys and values several times faster than json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+CACHE_DIR = os.getenv("GYMMANDO_CACHE_DIR", ".gymmando_cache")
+TTL_SECONDS = 24 * 60 * 60
+
+# Tool schemas only change with the server version, so they are kept per user for longer
+TOOLS_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "gymmando")
+TOOLS_TTL_SECONDS = 7 * 24 * 60 * 60
+
+# Only read-only (INFORMATIONAL) tools are safe to replay; anything that mutates is always called.
+# The verb has to lead the name (search-food, getVideoDetails) - delete_search_history is a command.
+# Tavily namespaces its tools (tavily-search, tavily-extract), so that prefix is skipped
+_INFORMATIONAL_TOOL = re.compile(r"^(?:tavily-)?(?:search|list|get|fetch|extract)(?:[-_A-Z]|$)")
+
+_db: Optional[sqlite3.Connection] = None
+
+
+def _connect() -> sqlite3.Connection:
+    """Open the cache database on first use."""
+    global _db
+    if _db is None:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        _db = sqlite3.connect(os.path.join(CACHE_DIR, "cache.sqlite3"), check_same_thread=False)
+        _db.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, ts REAL NOT NULL)"
+        )
+    return _db
+
+
+def _get(key: str) -> Optional[Any]:
+    # An unusable cache (e.g. CACHE_DIR not writable) is a miss, never a failed query
+    try:
+        row = _connect().execute("SELECT value, ts FROM cache WHERE key = ?", (key,)).fetchone()
+    except (sqlite3.Error, OSError) as exc:
+        logger.debug("Cache read failed: %s", exc)
+        return None
+    if row is None or time.time() - row[1] > TTL_SECONDS:
+        return None
+    return row[0]
+
+
+def _put(key: str, value: Any) -> None:
+    try:
+        db = _connect()
+        db.execute("INSERT OR REPLACE INTO cache (key, value, ts) VALUES (?, ?, ?)", (key, value, time.time()))
+        db.commit()
+    except (sqlite3.Error, OSError) as exc:
+        logger.debug("Cache write skipped: %s", exc)
+
+
+def _encode(obj: Any) -> Any:
+    """JSON fallback for the pydantic models used by the anthropic and mcp SDKs."""
+    if hasattr(obj, "model_dump"):
+        return obj.model_dump(mode="json", exclude_none=True)
+    if isinstance(obj, tuple):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _dumps(obj: Any, sort_keys: bool = False) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj, default=_encode, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+    return json.dumps(obj, sort_keys=sort_keys, default=_encode).encode()
+
+
+def _loads(data: Any) -> Any:
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+def _digest(obj: Any) -> str:
+    return hashlib.sha256(_dumps(obj, sort_keys=True)).hexdigest()
+
+
+class ToolSchemas(tuple):
+    """
+    Immutable Anthropic tool list built once per MCP session.
+
+    The digest used in Claude cache keys is computed on first use, so the tool
+    input_schemas are not re-serialized on every turn of the tool-use loop.
+    """
+
+    @cached_property
+    def digest(self) -> str:
+        return _digest(list(self))
+
+
+def tools_cache_path(server_params: StdioServerParameters, server_info: Implementation) -> str:
+    """Return the tools cache file for an MCP server command and the version it reports."""
+    key = _digest({
+        "command": server_params.command,
+        "args": server_params.args,
+        "server": [server_info.name, server_info.version],
+    })
+    return os.path.join(TOOLS_CACHE_DIR, f"tools_{key[:16]}.json")
+
+
+def load_tools(path: str) -> Optional[ToolSchemas]:
+    """Return the tool schemas saved at path, or None if missing or older than TOOLS_TTL_SECONDS."""
+    try:
+        if time.time() - os.path.getmtime(path) > TOOLS_TTL_SECONDS:
+            return None
+        with open(path, "rb") as f:
+            return ToolSchemas(_loads(f.read()))
+    except (OSError, ValueError):
+        return None
+
+
+async def fetch_tools(session: ClientSession, path: str) -> ToolSchemas:
+    """
+    List the server's tools in Anthropic format and save them to path.
+
+    Args:
+        session: Initialized MCP client session
+        path: Tools cache file from tools_cache_path()
+
+    Returns:
+        The tool schemas, with a prompt-cache breakpoint on the last tool
+    """
+    tools_response = await session.list_tools()
+    logger.debug("🛠️  Available tools: %s", [tool.name for tool in tools_response.tools])
+
+    anthropic_tools = [
+        {
+            "name": tool.name,
+            "description": tool.description,
+            "input_schema": tool.inputSchema
+        }
+        for tool in tools_response.tools
+    ]
+    # Cache breakpoint on the last tool covers every tool schema before it
+    if anthropic_tools:
+        anthropic_tools[-1]["cache_control"] = {"type": "ephemeral"}
+    tools = ToolSchemas(anthropic_tools)
+
+    # Write-then-rename so a concurrent reader never sees a partial file. The file only
+    # saves a round-trip next time, so a read-only HOME must not stop the client connecting
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(TOOLS_CACHE_DIR, exist_ok=True)
+        with open(tmp_path, "wb") as f:
+            f.write(_dumps(list(tools)))
+        os.replace(tmp_path, path)
+    except OSError as exc:
+        logger.warning("Could not save tool schemas to %s: %s", path, exc)
+    return tools
+
+
+def _to_blocks(content: List[Any]) -> List[Dict[str, Any]]:
+    """Convert MCP tool result content into Anthropic tool_result content blocks."""
+    blocks = []
+    for item in content:
+        if item.type == "text":
+            blocks.append({"type": "text", "text": item.text})
+        elif item.type == "image":
+            blocks.append({
+                "type": "image",
+                "source": {"type": "base64", "media_type": item.mimeType, "data": item.data}
+            })
+        else:
+            blocks.append({"type": "text", "text": item.model_dump_json()})
+    return blocks
+
+
+def is_informational(tool_name: str) -> bool:
+    """Return True for read-only tools (search / list / get style) whose results can be cached."""
+    return _INFORMATIONAL_TOOL.search(tool_name) is not None
+
+
+async def cached_call_tool(
+    session: ClientSession,
+    server_params: StdioServerParameters,
+    tool_name: str,
+    tool_input: Dict[str, Any]
+) -> List[Dict[str, Any]]:
+    """
+    Call an MCP tool, replaying cached results for informational tools.
+
+    Args:
+        session: Initialized MCP client session
+        server_params: Parameters the session's server was started with; they keep
+            tools of different servers that share a name (e.g. search) apart
+        tool_name: Name of the MCP tool
+        tool_input: Arguments for the tool
+
+    Returns:
+        Content blocks ready to use as a tool_result's content
+    """
+    cacheable = is_informational(tool_name)
+    if cacheable:
+        key = "tool:" + _digest({
+            "server": [server_params.command, server_params.args],
+            "tool": tool_name,
+            "input": tool_input,
+        })
+        hit = _get(key)
+        if hit is not None:
+            logger.debug("Tool cache hit: %s", tool_name)
+            return _loads(hit)
+
+    result = await session.call_tool(tool_name, tool_input)
+    content = _to_blocks(result.content)
+
+    if cacheable and not result.isError:
+        _put(key, _dumps(content))
+    return content
+
+
+async def cached_create(
+    client: AsyncAnthropic,
+    on_text: Optional[Callable[[str], None]] = None,
+    on_tool_use: Optional[Callable[[Any], None]] = None,
+    **kwargs: Any
+) -> Message:
+    """
+    Call client.messages.create, replaying an identical earlier request from the cache.
+
+    The key covers every request parameter (model, system, messages, tools, ...),
+    so only exact prompt replays are served from disk.
+
+    Args:
+        client: Claude client
+        on_text: Optional callback; when given, the response is streamed and
+            each text delta is passed to it as soon as it arrives
+        on_tool_use: Optional callback; when given, the response is streamed and
+            each tool_use block is passed to it as soon as its input is complete
+        **kwargs: Parameters for messages.create
+
+    Returns:
+        The complete Claude message
+    """
+    tools = kwargs.get("tools")
+    if isinstance(tools, ToolSchemas):
+        key = "claude:" + _digest({**kwargs, "tools": tools.digest})
+    else:
+        key = "claude:" + _digest(kwargs)
+    hit = _get(key)
+    if hit is not None:
+        logger.debug("Claude cache hit")
+        response = Message.model_validate_json(hit)
+        for block in response.content:
+            if block.type == "text" and on_text is not None:
+                on_text(block.text)
+            elif block.type == "tool_use" and on_tool_use is not None:
+                on_tool_use(block)
+        return response
+
+    if on_text is None and on_tool_use is None:
+        response = await client.messages.create(**kwargs)
+    else:
+        async with client.messages.stream(**kwargs) as stream:
+            async for event in stream:
+                if event.type == "text" and on_text is not None:
+                    on_text(event.text)
+                elif (
+                    event.type == "content_block_stop"
+                    and event.content_block.type == "tool_use"
+                    and on_tool_use is not None
+                ):
+                    on_tool_use(event.content_block)
+            response = await stream.get_final_message()
+
+    _put(key, response.model_dump_json())
+    return response
+
+
+class MCPSession:
+    """
+    One MCP server process with an initialized client session.
+
+    The subprocess and session are kept open on an AsyncExitStack until
+    close(), so every conversation in between reuses them. Tool schemas
+    saved by an earlier run skip the list_tools round-trip; the server's
+    own list replaces them in the background.
+    """
+
+    def __init__(self, server_params: StdioServerParameters):
+        """
+        Args:
+            server_params: How to start the MCP server
+        """
+        self.server_params = server_params
+        self.session: Optional[ClientSession] = None
+        self.tools = ToolSchemas()
+
+        self._stack: Optional[AsyncExitStack] = None
+        self._tools_refresh: Optional[asyncio.Task] = None
+
+    async def __aenter__(self) -> "MCPSession":
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        await self.close()
+
+    async def start(self) -> None:
+        """Start the server process and initialize the session."""
+        async with AsyncExitStack() as stack:
+            read, write = await stack.enter_async_context(stdio_client(self.server_params))
+            session = await stack.enter_async_context(ClientSession(read, write))
+            init_result = await session.initialize()
+
+            tools_path = tools_cache_path(self.server_params, init_result.serverInfo)
+            tools = load_tools(tools_path)
+            if tools is None:
+                tools = await fetch_tools(session, tools_path)
+            else:
+                self._tools_refresh = asyncio.create_task(self._refresh_tools(session, tools_path))
+            # Frozen once per session and reused by every turn
+            self.tools = tools
+
+            self._stack = stack.pop_all()
+            self.session = session
+
+    async def _refresh_tools(self, session: ClientSession, tools_path: str) -> None:
+        """Revalidate tool schemas loaded from disk against the running server."""
+        tools = await fetch_tools(session, tools_path)
+        if tools.digest != self.tools.digest:
+            self.tools = tools
+
+    async def call_tool(self, tool_name: str, tool_input: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Call a tool on this server through cached_call_tool()."""
+        return await cached_call_tool(self.session, self.server_params, tool_name, tool_input)
+
+    async def close(self) -> None:
+        """Shut down the session and server process."""
+        refresh, self._tools_refresh = self._tools_refresh, None
+        if refresh is not None:
+            refresh.cancel()
+            await asyncio.gather(refresh, return_exceptions=True)
+
+        stack, self._stack, self.session = self._stack, None, None
+        if stack is not None:
+            await stack.aclose()
+
+
+def print_text(text: str) -> None:
+    """Echo streamed response text as soon as it arrives."""
+    print(text, end="", flush=True)
+
+
+def partition(content: List[Any]) -> Tuple[List[Any], List[Any]]:
+    """Split response content into (text blocks, tool_use blocks) in a single pass."""
+    text_blocks: List[Any] = []
+    tool_use_blocks: List[Any] = []
+    for block in content:
+        if block.type == "tool_use":
+            tool_use_blocks.append(block)
+        elif block.type == "text":
+            text_blocks.append(block)
+    return text_blocks, tool_use_blocks
+
+
+async def ask_claude(client: AsyncAnthropic, stream: bool = True, **kwargs: Any) -> Message:
+    """
+    Send a request through cached_create() and print the reply's text.
+
+    Args:
+        client: Claude client
+        stream: Print text live as it arrives; otherwise print it once the reply
+            is complete, and not at all if it was cut off at max_tokens (the
+            caller regenerates it, so the partial answer is never shown)
+        **kwargs: Parameters for messages.create
+
+    Returns:
+        The complete Claude message
+    """
+    response = await cached_create(client, on_text=print_text if stream else None, **kwargs)
+    if not stream:
+        if response.stop_reason == "max_tokens":
+            return response
+        for block in response.content:
+            if block.type == "text":
+                print_text(block.text)
+    print("\n")
+    return response
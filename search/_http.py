@@ -0,0 +1,61 @@
+"""
+Shared Anthropic clients with a tuned HTTP connection pool, and the event loop they run on
+"""
+
+import asyncio
+import weakref
+from typing import Dict, Optional
+
+import httpx
+from anthropic import AsyncAnthropic, DefaultAsyncHttpxClient
+
+# One pool per process keeps TLS connections to the Anthropic API warm across queries
+HTTP_LIMITS = httpx.Limits(
+    max_keepalive_connections=100,
+    max_connections=200,
+    keepalive_expiry=30.0,
+)
+
+# HTTP/2 needs the optional `h2` package (pip install "httpx[http2]")
+try:
+    import h2  # noqa: F401
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
+
+# Async connections belong to the event loop that opened them, so pools are kept per loop
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict]" = weakref.WeakKeyDictionary()
+
+
+def get_async_anthropic(api_key: Optional[str] = None) -> AsyncAnthropic:
+    """
+    Return the shared AsyncAnthropic client for the running event loop.
+
+    Args:
+        api_key: Anthropic API key (defaults to the ANTHROPIC_API_KEY env var)
+    """
+    clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+    if api_key not in clients:
+        clients[api_key] = AsyncAnthropic(
+            api_key=api_key,
+            http_client=DefaultAsyncHttpxClient(limits=HTTP_LIMITS, http2=HTTP2),
+        )
+    return clients[api_key]
+
+
+def install_uvloop() -> bool:
+    """
+    Make asyncio.run() and new event loops use uvloop, which speeds up the MCP pipes and HTTP sockets.
+
+    uvloop is optional (not available on Windows); without it the default loop is kept.
+
+    Returns:
+        True if uvloop is now the event loop implementation
+    """
+    try:
+        import uvloop
+    except ImportError:
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
@@ -3,29 +3,61 @@ Open WebSearch MCP Integration - Complete Version
 """
 
 import asyncio
+import logging
 import os
-from anthropic import Anthropic
 from dotenv import load_dotenv
-from mcp import ClientSession, StdioServerParameters
-from mcp.client.stdio import stdio_client
+from mcp import StdioServerParameters
+
+from _cache import MCPSession, ask_claude, partition
+from _http import get_async_anthropic, install_uvloop
+from semantic_cache import SemanticCache, tools_used
 
 # Load environment variables
 load_dotenv()
 
+logger = logging.getLogger("gymmando")
+
+# Configure MCP server environment variables to suppress logs
+# The open-websearch server outputs logs to stdout, which breaks JSON-RPC protocol
+# Setting these env vars attempts to suppress the informational messages
+# stdio_client merges them over the SDK's default whitelist (HOME, PATH, USER, ...)
+MCP_ENV = {
+    "NODE_ENV": "production",  # Suppress development logs
+    "LOG_LEVEL": "silent",  # Suppress logging output
+    "SILENT": "1",  # Alternative silent flag
+}
+
+
+# Turns that only pick tools are short; the full budget is kept for the final answer
+MAX_TOKENS = 4096
+TOOL_TURN_MAX_TOKENS = 1024
+
 
 class GymandoSearch:
     """Search the web using Open-WebSearch MCP"""
     
     def __init__(self):
         """Initialize the search class"""
-        self.client = Anthropic()
-        print("✅ GymandoSearch initialized!")
+        self._server_params = StdioServerParameters(
+            command="npx",
+            args=["--quiet", "open-websearch"],  # --quiet suppresses npx output
+            env=MCP_ENV
+        )
+        self._mcp = None
+        self._start_lock = asyncio.Lock()
+        self._semantic_cache = SemanticCache()
+        logger.debug("✅ GymandoSearch initialized!")
+    
+    @property
+    def client(self):
+        """Shared Claude client for the running event loop"""
+        return get_async_anthropic()
     
-    def test_connection(self):
+    async def test_connection(self):
         """Test if Claude API is working"""
-        print("🧪 Testing Claude connection...")
+        logger.debug("🧪 Testing Claude connection...")
         
-        response = self.client.messages.create(
+        response = await self.client.messages.create(
             model="claude-sonnet-4-20250514",
             max_tokens=100,
             messages=[
@@ -37,130 +69,139 @@ class GymandoSearch:
         print(f"✅ Claude response: {result}\n")
         return result
     
+    async def __aenter__(self):
+        await self.start()
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+    
+    async def start(self):
+        """Start the MCP server once and keep the session open for reuse"""
+        # The lock stops concurrent start() calls from each spawning their own server
+        async with self._start_lock:
+            if self._mcp is not None:
+                return
+            
+            logger.debug("📡 Starting MCP server...")
+            
+            mcp = MCPSession(self._server_params)
+            await mcp.start()
+            logger.debug("✅ MCP server connected!")
+            
+            self._mcp = mcp
+    
+    async def close(self):
+        """Shut down the MCP session and server process"""
+        mcp, self._mcp = self._mcp, None
+        if mcp is not None:
+            await mcp.close()
+    
+    async def _ask_claude(self, mcp, messages, max_tokens, stream=True):
+        """Send the conversation to Claude and print its text - live, or once complete if not stream"""
+        return await ask_claude(
+            self.client,
+            stream,
+            model="claude-sonnet-4-20250514",
+            max_tokens=max_tokens,
+            messages=messages,
+            tools=mcp.tools
+        )
+    
     async def search_with_mcp(self, query: str):
         """Search using MCP server"""
         
-        # Configure MCP server parameters with environment variables to suppress logs
-        # The open-websearch server outputs logs to stdout, which breaks JSON-RPC protocol
-        # Setting these env vars attempts to suppress the informational messages
-        env = {
-            **os.environ,  # Inherit existing environment
-            "NODE_ENV": "production",  # Suppress development logs
-            "LOG_LEVEL": "silent",  # Suppress logging output
-            "SILENT": "1",  # Alternative silent flag
-        }
+        # Near-duplicate of an earlier question - answer without Claude or MCP
+        cached_answer = await self._semantic_cache.get(query)
+        if cached_answer is not None:
+            print(cached_answer)
+            return cached_answer
         
-        server_params = StdioServerParameters(
-            command="npx",
-            args=["--quiet", "open-websearch"],  # --quiet suppresses npx output
-            env=env
-        )
+        # Without a running session, open a private one just for this query. It is never
+        # stored on self, so a concurrent query can't reuse it or close it under this one,
+        # and the task that opens it is the one that closes it
+        if self._mcp is None:
+            async with MCPSession(self._server_params) as mcp:
+                return await self._search(query, mcp)
+        return await self._search(query, self._mcp)
+    
+    async def _search(self, query, mcp):
+        """Answer a query over an MCP session and remember the answer"""
+        logger.debug("🔍 Searching for: %r", query)
         
-        print(f"🔍 Searching for: '{query}'")
-        print("📡 Starting MCP server...")
+        # Ask Claude to search
+        messages = [{"role": "user", "content": query}]
         
-        # Connect to MCP server
-        async with stdio_client(server_params) as (read, write):
-            async with ClientSession(read, write) as session:
-                # Initialize session
-                await session.initialize()
-                print("✅ MCP server connected!\n")
-                
-                # List available tools
-                tools_response = await session.list_tools()
-                print(f"🛠️  Available tools: {[tool.name for tool in tools_response.tools]}\n")
-                
-                # Convert MCP tools to Anthropic format
-                anthropic_tools = []
-                for tool in tools_response.tools:
-                    anthropic_tools.append({
-                        "name": tool.name,
-                        "description": tool.description,
-                        "input_schema": tool.inputSchema
-                    })
-                
-                # Ask Claude to search
-                messages = [{"role": "user", "content": query}]
+        logger.debug("🤖 Asking Claude to search...")
+        
+        # Initial request to Claude - it usually just selects tools, so use the small budget
+        # Not streamed, so a truncated reply is never printed before it is regenerated
+        response = await self._ask_claude(mcp, messages, TOOL_TURN_MAX_TOKENS, stream=False)
+        if response.stop_reason == "max_tokens":
+            # Claude answered directly and outgrew that budget - regenerate with the full one
+            response = await self._ask_claude(mcp, messages, MAX_TOKENS)
+        text_blocks, tool_use_blocks = partition(response.content)
+        
+        # Handle tool use
+        if response.stop_reason == "tool_use":
+            # Call the MCP tool for every tool use block in the response
+            tool_results = []
+            for tool_use_block in tool_use_blocks:
+                tool_name = tool_use_block.name
+                tool_input = tool_use_block.input
                 
-                print("🤖 Asking Claude to search...\n")
+                logger.debug("🔧 Claude is using tool: %s (input: %s)", tool_name, tool_input)
                 
-                # Initial request to Claude
-                response = self.client.messages.create(
-                    model="claude-sonnet-4-20250514",
-                    max_tokens=4096,
-                    messages=messages,
-                    tools=anthropic_tools
-                )
+                # Call the MCP tool
+                logger.debug("⏳ Fetching search results...")
+                tool_result = await mcp.call_tool(tool_name, tool_input)
                 
-                # Handle tool use
-                if response.stop_reason == "tool_use":
-                    # Find tool use block
-                    tool_use_block = next(
-                        block for block in response.content 
-                        if block.type == "tool_use"
-                    )
-                    
-                    tool_name = tool_use_block.name
-                    tool_input = tool_use_block.input
-                    
-                    print(f"🔧 Claude is using tool: {tool_name}")
-                    print(f"   Input: {tool_input}\n")
-                    
-                    # Call the MCP tool
-                    print("⏳ Fetching search results...\n")
-                    tool_result = await session.call_tool(tool_name, tool_input)
-                    
-                    print("✅ Search results received!\n")
-                    
-                    # Add to conversation
-                    messages.append({
-                        "role": "assistant",
-                        "content": response.content
-                    })
-                    
-                    messages.append({
-                        "role": "user",
-                        "content": [{
-                            "type": "tool_result",
-                            "tool_use_id": tool_use_block.id,
-                            "content": tool_result.content
-                        }]
-                    })
-                    
-                    # Get Claude's final answer
-                    final_response = self.client.messages.create(
-                        model="claude-sonnet-4-20250514",
-                        max_tokens=4096,
-                        messages=messages,
-                        tools=anthropic_tools
-                    )
-                    
-                    # Extract text
-                    for block in final_response.content:
-                        if hasattr(block, "text") and block.text:
-                            final_text = block.text
-                            break
-                    else:
-                        final_text = "No text response found"
-                    
-                    print("="*60)
-                    print("CLAUDE'S ANSWER:")
-                    print("="*60)
-                    print(final_text)
-                    print("="*60)
-                    
-                    return final_text
+                logger.debug("✅ Search results received!")
                 
-                else:
-                    # Claude answered without using tools
-                    for block in response.content:
-                        if hasattr(block, "text") and block.text:
-                            text = block.text
-                            break
-                    else:
-                        text = "No text response found"
-                    print(text)
-                    return text
+                tool_results.append({
+                    "type": "tool_result",
+                    "tool_use_id": tool_use_block.id,
+                    "content": tool_result
+                })
+            
+            # Add to conversation
+            messages.append({
+                "role": "assistant",
+                "content": response.content
+            })
+            
+            messages.append({
+                "role": "user",
+                "content": tool_results
+            })
+            
+            # Get Claude's final answer
+            final_response = await self._ask_claude(mcp, messages, MAX_TOKENS)
+            
+            # Extract text
+            text_blocks, _ = partition(final_response.content)
+            final_text = next(
+                (block.text for block in text_blocks if block.text),
+                "No text response found"
+            )
+            
+            # The answer was already streamed to the console above
+            print("="*60)
+            
+            if text_blocks:
+                await self._semantic_cache.put(query, final_text, tools_used(messages))
+            
+            return final_text
+        
+        else:
+            # Claude answered without using tools
+            final_text = next(
+                (block.text for block in text_blocks if block.text),
+                "No text response found"
+            )
+            if text_blocks:
+                await self._semantic_cache.put(query, final_text)
+            return final_text
     
     def search(self, query: str):
         """Synchronous wrapper for search_with_mcp"""
@@ -169,10 +210,14 @@ class GymandoSearch:
 
 # Test it
 if __name__ == "__main__":
+    logging.basicConfig(level=os.getenv("GYMMANDO_LOG", "WARNING"))
+    
+    install_uvloop()
+    
     searcher = GymandoSearch()
     
     # Test connection
-    searcher.test_connection()
+    asyncio.run(searcher.test_connection())
     
     # Search the web
     result = searcher.search("What are the best exercises for lower back pain?")
\ No newline at end of file
@@ -3,26 +3,194 @@ OpenNutrition MCP Integration - Complete Version
 """
 
 import asyncio
+import atexit
+import concurrent.futures
+import itertools
+import json
+import logging
 import os
-from anthropic import Anthropic
+import sys
+import threading
+from collections import OrderedDict
+from contextlib import AsyncExitStack
+from pathlib import Path
 from dotenv import load_dotenv
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
 
+from _cache import ToolSchemas, cached_call_tool, cached_create
+from _http import get_async_anthropic, install_uvloop
+
 # Load environment variables
 load_dotenv()
 
+logger = logging.getLogger("gymmando")
+
+# orjson is optional; it reads and writes the answer cache file several times faster than json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Extra environment for the MCP server - stdio_client merges it over the SDK's
+# default whitelist (HOME, PATH, USER, ...) instead of copying all of os.environ.
+# OpenNutrition doesn't require an API key - it uses local database
+MCP_ENV = {
+    "NODE_ENV": "production",  # Suppress development logs
+    "LOG_LEVEL": "silent",  # Suppress logging output
+    "SILENT": "1",  # Alternative silent flag
+}
+
+# Keep the system prompt static so its prompt-cache key stays stable; the breakpoint
+# on it also covers the tool schemas, which come before it in the cached prefix
+SYSTEM_PROMPT = "You should only answer queries related to nutrition, food, and health. Do not answer any query not related to nutrition."
+SYSTEM_BLOCKS = [{"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}]
+
+# Final answers to recent questions, kept across runs
+ANSWER_CACHE_SIZE = 128
+ANSWER_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".gymmando", "nutrition_cache.json")
+
+
+def _normalize(query: str) -> str:
+    """Cache key for a question - case and whitespace don't change the answer"""
+    return " ".join(query.lower().split())
+
+
+def _print_answer(final_text: str):
+    """Print the final answer between banner lines"""
+    print("="*60)
+    print("CLAUDE'S ANSWER:")
+    print("="*60)
+    print(final_text)
+    print("="*60)
+
+
+def _to_anthropic_tools(tools_response):
+    """Convert an MCP tools listing to Anthropic tool schemas
+    
+    Frozen, so the cache key digest of the schemas is only computed once per listing.
+    """
+    return ToolSchemas(
+        {
+            "name": tool.name,
+            "description": tool.description,
+            "input_schema": tool.inputSchema
+        }
+        for tool in tools_response.tools
+    )
+
+
+async def _cancel_all(tasks):
+    """Cancel tool calls whose results won't be used and wait for them to finish"""
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+# Number of OpenNutrition server processes queries are spread over
+MCP_POOL_SIZE = int(os.getenv("GYMMANDO_MCP_POOL", "2"))
+
+
+class MCPPool:
+    """Round-robin pool of MCP sessions, each with its own server process
+    
+    A ClientSession multiplexes concurrent requests, so sessions are shared rather
+    than checked out; the pool only spreads the load so one busy Node process
+    doesn't hold up every concurrent query.
+    """
+    
+    def __init__(self, server_params, size=MCP_POOL_SIZE):
+        self.server_params = server_params
+        self.size = max(1, size)
+        self._stack = None
+        self._sessions = []
+        self._next = None
+    
+    async def start(self):
+        """Spawn the server processes and initialize their sessions concurrently
+        
+        Returns the tools listed by the first server - every server runs the same build.
+        """
+        # The exit stack keeps the subprocesses alive until close()
+        async with AsyncExitStack() as stack:
+            sessions = []
+            for _ in range(self.size):
+                read, write = await stack.enter_async_context(stdio_client(self.server_params))
+                sessions.append(await stack.enter_async_context(ClientSession(read, write)))
+            
+            tools_response, *_ = await asyncio.gather(
+                self._initialize_and_list_tools(sessions[0]),
+                *[session.initialize() for session in sessions[1:]]
+            )
+            
+            self._stack = stack.pop_all()
+            self._sessions = sessions
+            self._next = itertools.cycle(sessions)
+            return tools_response
+    
+    @staticmethod
+    async def _initialize_and_list_tools(session):
+        """Initialize a session with tools/list pipelined behind the handshake
+        
+        Saves a stdio round-trip; a server that rejects requests before the
+        initialized notification just gets list_tools again afterwards.
+        """
+        init_result, tools_response = await asyncio.gather(
+            session.initialize(),
+            session.list_tools(),
+            return_exceptions=True
+        )
+        if isinstance(init_result, BaseException):
+            raise init_result
+        if isinstance(tools_response, BaseException):
+            logger.debug("Pipelined list_tools failed (%s), retrying after initialize", tools_response)
+            tools_response = await session.list_tools()
+        return tools_response
+    
+    def acquire(self):
+        """Return the next session in round-robin order"""
+        return next(self._next)
+    
+    async def close(self):
+        """Shut down every session and server process"""
+        stack, self._stack, self._sessions, self._next = self._stack, None, [], None
+        if stack is not None:
+            await stack.aclose()
+
 
 class GymandoOpenNutrition:
     """Access nutrition database using OpenNutrition MCP"""
     
     def __init__(self):
         """Initialize the nutrition class"""
-        self.client = Anthropic()
-        print("✅ GymandoOpenNutrition initialized!")
+        # Resolved once here, so queries never touch the filesystem to find the server
+        self._server_params = self._create_server_params()
+        self._pool = None
+        self._anthropic_tools = ToolSchemas()
+        self._start_lock = asyncio.Lock()
+        self._answer_cache = self._load_answers()
+        
+        # Background event loop used by the synchronous query() wrapper
+        self._loop = None
+        self._thread = None
+        self._owner = None
+        self._stopping = None
+        logger.debug("✅ GymandoOpenNutrition initialized!")
     
-    async def query_with_mcp(self, query: str):
-        """Query nutrition database using OpenNutrition MCP server
+    @property
+    def client(self):
+        """Shared Claude client for the running event loop"""
+        return get_async_anthropic()
+    
+    async def __aenter__(self):
+        await self.start()
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+    
+    def _create_server_params(self):
+        """Build the OpenNutrition MCP server parameters
         
         Note: OpenNutrition MCP is not available via npm. You need to:
         1. Clone the repo: git clone https://github.com/deadletterq/mcp-opennutrition.git
@@ -32,153 +200,309 @@ class GymandoOpenNutrition:
            Example: export OPENNUTRITION_MCP_PATH=/path/to/mcp-opennutrition/build/index.js
         """
         
-        # Configure MCP server parameters with environment variables
-        # OpenNutrition doesn't require an API key - it uses local database
-        env = {
-            **os.environ,  # Inherit existing environment
-            "NODE_ENV": "production",  # Suppress development logs
-            "LOG_LEVEL": "silent",  # Suppress logging output
-            "SILENT": "1",  # Alternative silent flag
-        }
-        
         # Check if local path is configured
         local_path = os.getenv("OPENNUTRITION_MCP_PATH")
         if local_path:
             # Use local installation (recommended method)
-            if not os.path.exists(local_path):
+            try:
+                server_path = Path(local_path).resolve(strict=True)
+            except FileNotFoundError:
                 raise FileNotFoundError(
                     f"OpenNutrition MCP not found at {local_path}.\n"
                     "Please install it by running:\n"
                     "  1. git clone https://github.com/deadletterq/mcp-opennutrition.git\n"
                     "  2. cd mcp-opennutrition && npm install && npm run build\n"
                     "  3. Set OPENNUTRITION_MCP_PATH=/path/to/mcp-opennutrition/build/index.js"
-                )
+                ) from None
             server_params = StdioServerParameters(
                 command="node",
-                args=[os.path.abspath(local_path)],
-                env=env
+                args=[str(server_path)],
+                env=MCP_ENV
             )
-            print(f"📍 Using local OpenNutrition MCP at: {local_path}")
+            logger.debug("📍 Using local OpenNutrition MCP at: %s", local_path)
         else:
             # Try using npx with GitHub (may not work - local installation recommended)
-            print("⚠️  Warning: OPENNUTRITION_MCP_PATH not set. Attempting to use GitHub via npx...")
-            print("   For best results, install locally and set OPENNUTRITION_MCP_PATH")
+            logger.warning(
+                "⚠️  OPENNUTRITION_MCP_PATH not set. Attempting to use GitHub via npx... "
+                "For best results, install locally and set OPENNUTRITION_MCP_PATH"
+            )
             server_params = StdioServerParameters(
                 command="npx",
                 args=["--quiet", "-y", "github:deadletterq/mcp-opennutrition"],
-                env=env
+                env=MCP_ENV
             )
+        return server_params
+    
+    async def start(self):
+        """Start the OpenNutrition MCP servers once and keep their sessions open for reuse"""
+        # The lock stops concurrent start() calls from each spawning their own pool
+        async with self._start_lock:
+            if self._pool is not None:
+                return
+            
+            logger.debug("📡 Starting %d OpenNutrition MCP server(s)...", MCP_POOL_SIZE)
+            
+            pool = MCPPool(self._server_params)
+            tools_response = await pool.start()
+            logger.debug("✅ OpenNutrition MCP server connected!")
+            logger.debug("🛠️  Available tools: %s", [tool.name for tool in tools_response.tools])
+            
+            # Convert MCP tools to Anthropic format once per pool; every query reuses them
+            self._anthropic_tools = _to_anthropic_tools(tools_response)
+            
+            self._pool = pool
+    
+    async def close(self):
+        """Shut down the MCP sessions and server processes"""
+        pool, self._pool = self._pool, None
+        if pool is not None:
+            await pool.close()
+        self._save_answers()
+    
+    def _load_answers(self):
+        """Load the answer cache saved by an earlier run, if any"""
+        try:
+            with open(ANSWER_CACHE_PATH, "rb") as f:
+                data = f.read()
+            answers = OrderedDict(orjson.loads(data) if orjson is not None else json.loads(data))
+        except (OSError, ValueError):
+            return OrderedDict()
+        while len(answers) > ANSWER_CACHE_SIZE:
+            answers.popitem(last=False)
+        return answers
+    
+    def _save_answers(self):
+        """Write the answer cache to disk (write-then-rename, so a crash never leaves half a file)
+        
+        Best-effort: it runs in finally blocks and at exit, where raising would
+        replace the query's own result or exception.
+        """
+        tmp_path = f"{ANSWER_CACHE_PATH}.{os.getpid()}.tmp"
+        items = list(self._answer_cache.items())
+        try:
+            os.makedirs(os.path.dirname(ANSWER_CACHE_PATH), exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                f.write(orjson.dumps(items) if orjson is not None else json.dumps(items).encode())
+            os.replace(tmp_path, ANSWER_CACHE_PATH)
+        except OSError as exc:
+            logger.warning("Could not save the answer cache to %s: %s", ANSWER_CACHE_PATH, exc)
+    
+    def _remember(self, key, final_text):
+        """Store an answer as most recently used, evicting the oldest past ANSWER_CACHE_SIZE"""
+        self._answer_cache[key] = final_text
+        self._answer_cache.move_to_end(key)
+        while len(self._answer_cache) > ANSWER_CACHE_SIZE:
+            self._answer_cache.popitem(last=False)
+    
+    async def _stream_turn(self, session, messages, base_kwargs):
+        """Stream one Claude turn, starting each MCP tool call as soon as its input is complete
         
-        print(f"🔍 Querying nutrition database for: '{query}'")
-        print("📡 Starting OpenNutrition MCP server...")
+        Returns the final message and one task per tool_use block, in content order.
+        Claude only batches independent calls, so they run concurrently with each
+        other and with the rest of the response.
+        """
+        tool_calls = []
         
-        # Connect to MCP server
-        async with stdio_client(server_params) as (read, write):
-            async with ClientSession(read, write) as session:
-                # Initialize session
-                await session.initialize()
-                print("✅ OpenNutrition MCP server connected!\n")
-                
-                # List available tools
-                tools_response = await session.list_tools()
-                print(f"🛠️  Available tools: {[tool.name for tool in tools_response.tools]}\n")
-                
-                # Convert MCP tools to Anthropic format
-                anthropic_tools = []
-                for tool in tools_response.tools:
-                    anthropic_tools.append({
-                        "name": tool.name,
-                        "description": tool.description,
-                        "input_schema": tool.inputSchema
-                    })
+        def on_tool_use(block):
+            tool_calls.append(asyncio.create_task(cached_call_tool(session, self._server_params, block.name, block.input)))
+        
+        try:
+            response = await cached_create(self.client, on_tool_use=on_tool_use, messages=messages, **base_kwargs)
+        except BaseException:
+            # The stream failed partway - don't leave calls it already started running unobserved
+            await _cancel_all(tool_calls)
+            raise
+        return response, tool_calls
+    
+    async def query_with_mcp(self, query: str):
+        """Query nutrition database using OpenNutrition MCP server"""
+        
+        # Same question as a recent one - answer without Claude or MCP
+        key = _normalize(query)
+        cached_answer = self._answer_cache.get(key)
+        if cached_answer is not None:
+            self._answer_cache.move_to_end(key)
+            _print_answer(cached_answer)
+            return cached_answer
+        
+        # Without running sessions, open a private single-server pool just for this query.
+        # It is never stored on self, so a concurrent one-shot query can't close it under
+        # this one, and the task that opens it is the one that closes it
+        if self._pool is None:
+            pool = MCPPool(self._server_params, size=1)
+            tools = _to_anthropic_tools(await pool.start())
+            try:
+                return await self._query(query, key, pool.acquire(), tools)
+            finally:
+                await pool.close()
+                self._save_answers()
+        
+        return await self._query(query, key, self._pool.acquire(), self._anthropic_tools)
+    
+    async def _query(self, query, key, session, tools):
+        """Answer a query over an MCP session and remember the answer under key"""
+        logger.debug("🔍 Querying nutrition database for: %r", query)
+        
+        # Parameters shared by every Claude request for this query
+        base_kwargs = {
+            "model": "claude-sonnet-4-20250514",
+            "max_tokens": 4096,
+            "system": SYSTEM_BLOCKS,
+            "tools": tools
+        }
+        
+        # Ask Claude to query nutrition database
+        messages = [{"role": "user", "content": query}]
+        
+        logger.debug("🤖 Asking Claude to query nutrition database...")
+        
+        # Initial request to Claude - tool calls start while it is still streaming
+        response, tool_calls = await self._stream_turn(session, messages, base_kwargs)
+        
+        try:
+            # Handle tool use - OpenNutrition might make multiple tool calls
+            while response.stop_reason == "tool_use":
+                # Find tool use blocks (there might be multiple)
+                tool_use_blocks = [
+                    block for block in response.content 
+                    if block.type == "tool_use"
+                ]
                 
-                # Ask Claude to query nutrition database
-                messages = [{"role": "user", "content": query}]
+                # Add assistant response to messages
+                messages.append({
+                    "role": "assistant",
+                    "content": response.content
+                })
                 
-                print("🤖 Asking Claude to query nutrition database...\n")
+                # The MCP tool calls were started during the stream; wait for all of them
+                logger.debug("⏳ Fetching nutrition data...")
+                tool_results = await asyncio.gather(*tool_calls)
                 
-                # Initial request to Claude
-                response = self.client.messages.create(
-                    model="claude-sonnet-4-20250514",
-                    max_tokens=4096,
-                    system="You should only answer queries related to nutrition, food, and health. Do not answer any query not related to nutrition.",
-                    messages=messages,
-                    tools=anthropic_tools
-                )
+                for tool_use_block in tool_use_blocks:
+                    logger.debug("🔧 Claude used tool: %s (input: %s)", tool_use_block.name, tool_use_block.input)
+                logger.debug("✅ Nutrition data received!")
                 
-                # Handle tool use - OpenNutrition might make multiple tool calls
-                while response.stop_reason == "tool_use":
-                    # Find tool use blocks (there might be multiple)
-                    tool_use_blocks = [
-                        block for block in response.content 
-                        if block.type == "tool_use"
+                # Add all tool results to messages in a single user turn, in tool_use order
+                messages.append({
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "tool_result",
+                            "tool_use_id": tool_use_block.id,
+                            "content": tool_result
+                        }
+                        for tool_use_block, tool_result in zip(tool_use_blocks, tool_results)
                     ]
-                    
-                    # Add assistant response to messages
-                    messages.append({
-                        "role": "assistant",
-                        "content": response.content
-                    })
-                    
-                    # Process each tool use
-                    for tool_use_block in tool_use_blocks:
-                        tool_name = tool_use_block.name
-                        tool_input = tool_use_block.input
-                        
-                        print(f"🔧 Claude is using tool: {tool_name}")
-                        print(f"   Input: {tool_input}\n")
-                        
-                        # Call the MCP tool
-                        print("⏳ Fetching nutrition data...\n")
-                        tool_result = await session.call_tool(tool_name, tool_input)
-                        
-                        print("✅ Nutrition data received!\n")
-                        
-                        # Add tool result to messages
-                        messages.append({
-                            "role": "user",
-                            "content": [{
-                                "type": "tool_result",
-                                "tool_use_id": tool_use_block.id,
-                                "content": tool_result.content
-                            }]
-                        })
-                    
-                    # Get Claude's next response (might use more tools or provide final answer)
-                    response = self.client.messages.create(
-                        model="claude-sonnet-4-20250514",
-                        max_tokens=4096,
-                        system="You should only answer queries related to nutrition, food, and health. Do not answer any query not related to nutrition.",
-                        messages=messages,
-                        tools=anthropic_tools
-                    )
-                
-                # Extract final text response
-                for block in response.content:
-                    if hasattr(block, "text") and block.text:
-                        final_text = block.text
-                        break
-                else:
-                    final_text = "No text response found"
+                })
                 
-                print("="*60)
-                print("CLAUDE'S ANSWER:")
-                print("="*60)
-                print(final_text)
-                print("="*60)
-                
-                return final_text
+                # Get Claude's next response (might use more tools or provide final answer)
+                response, tool_calls = await self._stream_turn(session, messages, base_kwargs)
+        finally:
+            # Calls from a turn that ended without asking for their results (max_tokens,
+            # refusal, ...) or left pending by an error are cancelled rather than orphaned
+            await _cancel_all(tool_calls)
+        
+        # Extract final text response - the first non-empty text block
+        final_text = next(
+            (block.text for block in response.content if block.type == "text" and block.text),
+            None
+        )
+        if final_text is not None:
+            self._remember(key, final_text)
+        else:
+            final_text = "No text response found"
+        
+        _print_answer(final_text)
+        
+        return final_text
+    
+    def _ensure_loop(self):
+        """Start the background event loop and open the MCP session on it (first call only)"""
+        if self._loop is None:
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name="opennutrition-mcp", daemon=True)
+            thread.start()
+            
+            ready = concurrent.futures.Future()
+            owner = asyncio.run_coroutine_threadsafe(self._own_session(ready), loop)
+            try:
+                ready.result()
+            except BaseException:
+                loop.call_soon_threadsafe(loop.stop)
+                thread.join()
+                loop.close()
+                raise
+            
+            self._loop, self._thread, self._owner = loop, thread, owner
+            atexit.register(self._shutdown)
+        return self._loop
+    
+    async def _own_session(self, ready):
+        """Hold the MCP sessions open on the background loop until _shutdown()"""
+        self._stopping = asyncio.Event()
+        try:
+            await self.start()
+        except BaseException as exc:
+            ready.set_exception(exc)
+            return
+        ready.set_result(None)
+        
+        # stdio_client's task group must be exited by the task that entered it,
+        # so this task also closes the sessions
+        try:
+            await self._stopping.wait()
+        finally:
+            await self.close()
+    
+    def _shutdown(self):
+        """Close the background sessions and stop their loop (runs at interpreter exit)"""
+        loop, self._loop = self._loop, None
+        if loop is None:
+            return
+        
+        loop.call_soon_threadsafe(self._stopping.set)
+        try:
+            self._owner.result(timeout=10)
+        except Exception:
+            pass
+        loop.call_soon_threadsafe(loop.stop)
+        self._thread.join()
+        loop.close()
     
     def query(self, query: str):
-        """Synchronous wrapper for query_with_mcp"""
-        return asyncio.run(self.query_with_mcp(query))
+        """Synchronous wrapper for query_with_mcp
+        
+        Runs on a long-lived background event loop, so the MCP session and its
+        connections survive between calls instead of being torn down by asyncio.run
+        """
+        loop = self._ensure_loop()
+        return asyncio.run_coroutine_threadsafe(self.query_with_mcp(query), loop).result()
+
+
+async def answer_all(nutrition, queries):
+    """Answer every query concurrently, spread over the pooled MCP sessions"""
+    async with nutrition:
+        return await asyncio.gather(*[nutrition.query_with_mcp(query) for query in queries])
 
 
 # Test it
 if __name__ == "__main__":
+    logging.basicConfig(level=os.getenv("GYMMANDO_LOG", "WARNING"))
+    
+    # The background loop behind query() comes from asyncio.new_event_loop(), so it picks this up
+    install_uvloop()
+    
     nutrition = GymandoOpenNutrition()
-    while True:
-        user_input = input("Ask about nutrition: ")
-        if user_input == "q":
-            break
-        result = nutrition.query(user_input)
+    
+    # Batch mode: questions from the command line, or one per line of piped stdin
+    if "--batch" in sys.argv or not sys.stdin.isatty():
+        queries = [arg for arg in sys.argv[1:] if arg != "--batch"]
+        if not queries:
+            queries = [line.strip() for line in sys.stdin if line.strip()]
+        asyncio.run(answer_all(nutrition, queries))
+    else:
+        while True:
+            user_input = input("Ask about nutrition: ")
+            if user_input == "q":
+                break
+            result = nutrition.query(user_input)
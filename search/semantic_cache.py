@@ -0,0 +1,127 @@
+"""
+Semantic cache - answers near-duplicate questions without calling Claude
+"""
+
+import asyncio
+import logging
+import threading
+from typing import Any, Dict, Iterable, List, Optional
+
+from _cache import is_informational
+
+logger = logging.getLogger("gymmando")
+
+MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+SIMILARITY_THRESHOLD = 0.92
+
+# Embedding search needs the optional sentence-transformers + faiss-cpu packages
+try:
+    import faiss
+    import numpy as np
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    SentenceTransformer = None
+
+
+def tools_used(messages: List[Dict[str, Any]]) -> List[str]:
+    """Return the names of every tool Claude called in a conversation."""
+    return [
+        block.name
+        for message in messages
+        if message["role"] == "assistant" and not isinstance(message["content"], str)
+        for block in message["content"]
+        if getattr(block, "type", None) == "tool_use"
+    ]
+
+
+class SemanticCache:
+    """
+    In-process cache of (query embedding, answer) pairs.
+
+    Embeddings are L2-normalized, so the inner product search of a FAISS
+    IndexFlatIP is cosine similarity. When the optional dependencies are not
+    installed, or the model can't be loaded (e.g. offline and not downloaded
+    yet), the cache is disabled and every lookup misses.
+    """
+
+    def __init__(self, model_name: str = MODEL_NAME, threshold: float = SIMILARITY_THRESHOLD):
+        """
+        Args:
+            model_name: Sentence-transformers model used to embed queries
+            threshold: Minimum cosine similarity for a cache hit
+        """
+        self.model_name = model_name
+        self.threshold = threshold
+        self.enabled = SentenceTransformer is not None
+
+        self._model = None
+        self._index = None
+        self._answers: List[str] = []
+        self._load_lock = threading.Lock()
+        self._last_embedding = None  # (query, embedding) - put() follows get() for the same query
+
+    def _load(self) -> bool:
+        """Load the embedding model and create the index (slow, runs once).
+
+        Returns False, and disables the cache, if the model can't be loaded.
+        """
+        with self._load_lock:
+            if self._model is None and self.enabled:
+                try:
+                    model = SentenceTransformer(self.model_name)
+                except Exception:
+                    logger.warning("Semantic cache disabled: could not load %s", self.model_name, exc_info=True)
+                    self.enabled = False
+                    return False
+                self._index = faiss.IndexFlatIP(model.get_sentence_embedding_dimension())
+                self._model = model
+            return self._model is not None
+
+    def _embed(self, query: str) -> Optional[Any]:
+        # Read once - chat_many runs several _embed calls on worker threads at a time
+        last = self._last_embedding
+        if last is not None and last[0] == query:
+            return last[1]
+        if not self._load():
+            return None
+        embedding = self._model.encode([query], normalize_embeddings=True).astype(np.float32)
+        self._last_embedding = (query, embedding)
+        return embedding
+
+    async def warmup(self) -> None:
+        """Load the embedding model in the background before the first lookup."""
+        if self.enabled:
+            await asyncio.to_thread(self._load)
+
+    async def get(self, query: str) -> Optional[str]:
+        """Return the cached answer to a near-duplicate query, if any."""
+        if not self.enabled:
+            return None
+
+        embedding = await asyncio.to_thread(self._embed, query)
+        if embedding is None or self._index.ntotal == 0:
+            return None
+
+        scores, ids = self._index.search(embedding, 1)
+        if scores[0][0] < self.threshold:
+            return None
+        logger.debug("Semantic cache hit (similarity %.3f)", scores[0][0])
+        return self._answers[ids[0][0]]
+
+    async def put(self, query: str, answer: str, tool_names: Iterable[str] = ()) -> None:
+        """
+        Remember an answer for a query.
+
+        Answers that depended on a non-informational (command) tool are not
+        admitted, since replaying them would skip a side effect.
+        """
+        if not self.enabled or not answer:
+            return
+        if not all(is_informational(name) for name in tool_names):
+            return
+
+        embedding = await asyncio.to_thread(self._embed, query)
+        if embedding is None:
+            return
+        self._index.add(embedding)
+        self._answers.append(answer)
@@ -3,146 +3,268 @@ Tavily MCP Integration - Complete Version
 """
 
 import asyncio
+import logging
 import os
-from anthropic import Anthropic
+import re
+import threading
 from dotenv import load_dotenv
-from mcp import ClientSession, StdioServerParameters
-from mcp.client.stdio import stdio_client
+from mcp import StdioServerParameters
+
+from _cache import MCPSession, ask_claude, partition
+from _http import get_async_anthropic, install_uvloop
+from semantic_cache import SemanticCache, tools_used
+
+# aioconsole is optional; without it the prompt is read on a daemon thread. Not an
+# executor thread - asyncio.run joins those on exit, so Ctrl-C would hang until Enter
+try:
+    from aioconsole import ainput
+except ImportError:
+    async def ainput(prompt: str = "") -> str:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        
+        def settle(line, exc):
+            if future.done():
+                return
+            if exc is not None:
+                future.set_exception(exc)
+            else:
+                future.set_result(line)
+        
+        def read():
+            try:
+                line, exc = input(prompt), None
+            except Exception as e:
+                line, exc = None, e
+            try:
+                loop.call_soon_threadsafe(settle, line, exc)
+            except RuntimeError:
+                pass  # the loop closed while the prompt was open
+        
+        threading.Thread(target=read, name="ainput", daemon=True).start()
+        return await future
+
 
 # Load environment variables
 load_dotenv()
 
+logger = logging.getLogger("gymmando")
+
+# Extra environment for the MCP server - stdio_client merges it over the SDK's
+# default whitelist (HOME, PATH, USER, ...) instead of copying all of os.environ
+MCP_ENV = {
+    "NODE_ENV": "production",  # Suppress development logs
+    "LOG_LEVEL": "silent",  # Suppress logging output
+    "SILENT": "1",  # Alternative silent flag
+}
+
+
+# Keep the system prompt static (no per-query data) so its prompt-cache key stays stable
+SYSTEM_PROMPT = "You should only answer queries related to exercises, workouts, and fitness. Do not answer any query not related to exercises."
+SYSTEM_BLOCKS = [{"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}]
+
+# Cheap local guard for the same rule: requests that are unmistakably off-topic are refused
+# without calling Claude. Only phrases that can't occur in a fitness question are listed -
+# training vocabulary such as "programming" or "translate to" must never match - and
+# anything it doesn't match goes to Claude, which still applies the system prompt
+_LANGUAGES = "english|spanish|french|german|italian|portuguese|chinese|japanese|korean|russian|arabic|hindi"
+_OFF_TOPIC_QUERY = re.compile(
+    r"\b(?:"
+    r"write (?:a |an |some |me a |me some )?(?:python|javascript|typescript|java|sql|html|css|c\+\+)\b|"
+    r"(?:python|javascript|typescript|sql) (?:code|script|function|program)|"
+    r"write (?:a |an |me a )?(?:essay|story|poem|haiku|song lyrics)|"
+    r"capital (?:city )?of|stock price|share price|bitcoin|cryptocurrency|ethereum|"
+    rf"translate .* (?:in)?to (?:{_LANGUAGES})\b"
+    r")",
+    re.IGNORECASE,
+)
+OFF_TOPIC_REPLY = "Sorry, I can only help with questions about exercises, workouts, and fitness."
+
+
+def _is_off_topic(query: str) -> bool:
+    """Return True only for queries that are certainly not about exercise / fitness
+    
+    >>> _is_off_topic("Write a python script that sorts a list")
+    True
+    >>> _is_off_topic("Translate this sentence into Spanish")
+    True
+    >>> _is_off_topic("What's the best programming for hypertrophy?")
+    False
+    >>> _is_off_topic("How should I structure my strength programming as a beginner?")
+    False
+    >>> _is_off_topic("Will my squat strength translate to faster sprinting?")
+    False
+    >>> _is_off_topic("Write me a 4-day workout program")
+    False
+    """
+    return _OFF_TOPIC_QUERY.search(query) is not None
+
+
+# Turns that only pick tools are short; the full budget is kept for the final answer
+MAX_TOKENS = 4096
+TOOL_TURN_MAX_TOKENS = 1024
+
 
 class GymandoTavilySearch:
     """Search the web using Tavily MCP"""
     
     def __init__(self):
         """Initialize the search class"""
-        self.client = Anthropic()
-        print("✅ GymandoTavilySearch initialized!")
+        self._server_params = None
+        self._mcp = None
+        self._start_lock = asyncio.Lock()
+        self._semantic_cache = SemanticCache()
+        logger.debug("✅ GymandoTavilySearch initialized!")
+    
+    @property
+    def client(self):
+        """Shared Claude client for the running event loop"""
+        return get_async_anthropic()
+    
+    async def __aenter__(self):
+        await self.start()
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+    
+    def _get_server_params(self):
+        """Build the Tavily MCP server parameters on first use and reuse them afterwards"""
+        if self._server_params is None:
+            # Check for Tavily API key
+            tavily_api_key = os.getenv("TAVILY_API_KEY")
+            if not tavily_api_key:
+                raise ValueError("TAVILY_API_KEY environment variable is required")
+            
+            self._server_params = StdioServerParameters(
+                command="npx",
+                args=["--quiet", "-y", "tavily-mcp@latest"],  # --quiet suppresses npx output, -y auto-installs
+                env={**MCP_ENV, "TAVILY_API_KEY": tavily_api_key}
+            )
+        return self._server_params
+    
+    async def start(self):
+        """Start the Tavily MCP server once and keep the session open for reuse"""
+        # The lock stops concurrent start() calls from each spawning their own server
+        async with self._start_lock:
+            if self._mcp is not None:
+                return
+            
+            logger.debug("📡 Starting Tavily MCP server...")
+            
+            mcp = MCPSession(self._get_server_params())
+            await mcp.start()
+            logger.debug("✅ Tavily MCP server connected!")
+            
+            self._mcp = mcp
+    
+    async def close(self):
+        """Shut down the MCP session and server process"""
+        mcp, self._mcp = self._mcp, None
+        if mcp is not None:
+            await mcp.close()
+    
+    async def _ask_claude(self, mcp, messages, max_tokens, stream=True):
+        """Send the conversation to Claude and print its text - live, or once complete if not stream"""
+        return await ask_claude(
+            self.client,
+            stream,
+            model="claude-sonnet-4-20250514",
+            max_tokens=max_tokens,
+            system=SYSTEM_BLOCKS,
+            messages=messages,
+            tools=mcp.tools
+        )
     
     async def search_with_mcp(self, query: str):
         """Search using Tavily MCP server"""
         
-        # Check for Tavily API key
-        tavily_api_key = os.getenv("TAVILY_API_KEY")
-        if not tavily_api_key:
-            raise ValueError("TAVILY_API_KEY environment variable is required")
+        # Clearly off-topic - refuse locally instead of paying Claude to do it
+        if _is_off_topic(query):
+            print(OFF_TOPIC_REPLY)
+            return OFF_TOPIC_REPLY
+        
+        # Near-duplicate of an earlier question - answer without Claude or MCP
+        cached_answer = await self._semantic_cache.get(query)
+        if cached_answer is not None:
+            print(cached_answer)
+            return cached_answer
+        
+        # Without a running session, open a private one just for this query. It is never
+        # stored on self, so a concurrent query can't reuse it or close it under this one,
+        # and the task that opens it is the one that closes it
+        if self._mcp is None:
+            async with MCPSession(self._get_server_params()) as mcp:
+                return await self._search(query, mcp)
+        return await self._search(query, self._mcp)
+    
+    async def _search(self, query, mcp):
+        """Answer a query over an MCP session and remember the answer"""
+        logger.debug("🔍 Searching for: %r", query)
         
-        # Configure MCP server parameters with environment variables
-        env = {
-            **os.environ,  # Inherit existing environment
-            "TAVILY_API_KEY": tavily_api_key,  # Set Tavily API key
-            "NODE_ENV": "production",  # Suppress development logs
-            "LOG_LEVEL": "silent",  # Suppress logging output
-            "SILENT": "1",  # Alternative silent flag
-        }
+        # Ask Claude to search
+        messages = [{"role": "user", "content": query}]
         
-        server_params = StdioServerParameters(
-            command="npx",
-            args=["--quiet", "-y", "tavily-mcp@latest"],  # --quiet suppresses npx output, -y auto-installs
-            env=env
+        logger.debug("🤖 Asking Claude to search...")
+        
+        # Initial request to Claude - it usually just selects tools, so use the small budget
+        # Not streamed, so a truncated reply is never printed before it is regenerated
+        response = await self._ask_claude(mcp, messages, TOOL_TURN_MAX_TOKENS, stream=False)
+        if response.stop_reason == "max_tokens":
+            # Claude answered directly and outgrew that budget - regenerate with the full one
+            response = await self._ask_claude(mcp, messages, MAX_TOKENS)
+        text_blocks, tool_use_blocks = partition(response.content)
+        
+        # Handle tool use - Tavily might make multiple tool calls
+        while response.stop_reason == "tool_use":
+            # Add assistant response to messages
+            messages.append({
+                "role": "assistant",
+                "content": response.content
+            })
+            
+            for tool_use_block in tool_use_blocks:
+                logger.debug("🔧 Claude is using tool: %s (input: %s)", tool_use_block.name, tool_use_block.input)
+            
+            # Call the MCP tools concurrently - Claude only batches independent calls
+            logger.debug("⏳ Fetching search results...")
+            tool_results = await asyncio.gather(*[
+                mcp.call_tool(tool_use_block.name, tool_use_block.input)
+                for tool_use_block in tool_use_blocks
+            ])
+            
+            logger.debug("✅ Search results received!")
+            
+            # Add all tool results to messages in a single user turn, in tool_use order
+            messages.append({
+                "role": "user",
+                "content": [
+                    {
+                        "type": "tool_result",
+                        "tool_use_id": tool_use_block.id,
+                        "content": tool_result
+                    }
+                    for tool_use_block, tool_result in zip(tool_use_blocks, tool_results)
+                ]
+            })
+            
+            # Get Claude's next response (might use more tools or provide final answer)
+            response = await self._ask_claude(mcp, messages, MAX_TOKENS)
+            text_blocks, tool_use_blocks = partition(response.content)
+        
+        # Extract final text response
+        final_text = next(
+            (block.text for block in text_blocks if block.text),
+            "No text response found"
         )
         
-        print(f"🔍 Searching for: '{query}'")
-        print("📡 Starting Tavily MCP server...")
+        # The answer was already streamed to the console above
+        print("="*60)
+        
+        if text_blocks:
+            await self._semantic_cache.put(query, final_text, tools_used(messages))
         
-        # Connect to MCP server
-        async with stdio_client(server_params) as (read, write):
-            async with ClientSession(read, write) as session:
-                # Initialize session
-                await session.initialize()
-                print("✅ Tavily MCP server connected!\n")
-                
-                # List available tools
-                tools_response = await session.list_tools()
-                print(f"🛠️  Available tools: {[tool.name for tool in tools_response.tools]}\n")
-                
-                # Convert MCP tools to Anthropic format
-                anthropic_tools = []
-                for tool in tools_response.tools:
-                    anthropic_tools.append({
-                        "name": tool.name,
-                        "description": tool.description,
-                        "input_schema": tool.inputSchema
-                    })
-                
-                # Ask Claude to search
-                messages = [{"role": "user", "content": query}]
-                
-                print("🤖 Asking Claude to search...\n")
-                
-                # Initial request to Claude
-                response = self.client.messages.create(
-                    model="claude-sonnet-4-20250514",
-                    max_tokens=4096,
-                    system="You should only answer queries related to exercises, workouts, and fitness. Do not answer any query not related to exercises.",
-                    messages=messages,
-                    tools=anthropic_tools
-                )
-                
-                # Handle tool use - Tavily might make multiple tool calls
-                while response.stop_reason == "tool_use":
-                    # Find tool use blocks (there might be multiple)
-                    tool_use_blocks = [
-                        block for block in response.content 
-                        if block.type == "tool_use"
-                    ]
-                    
-                    # Add assistant response to messages
-                    messages.append({
-                        "role": "assistant",
-                        "content": response.content
-                    })
-                    
-                    # Process each tool use
-                    for tool_use_block in tool_use_blocks:
-                        tool_name = tool_use_block.name
-                        tool_input = tool_use_block.input
-                        
-                        print(f"🔧 Claude is using tool: {tool_name}")
-                        print(f"   Input: {tool_input}\n")
-                        
-                        # Call the MCP tool
-                        print("⏳ Fetching search results...\n")
-                        tool_result = await session.call_tool(tool_name, tool_input)
-                        
-                        print("✅ Search results received!\n")
-                        
-                        # Add tool result to messages
-                        messages.append({
-                            "role": "user",
-                            "content": [{
-                                "type": "tool_result",
-                                "tool_use_id": tool_use_block.id,
-                                "content": tool_result.content
-                            }]
-                        })
-                    
-                    # Get Claude's next response (might use more tools or provide final answer)
-                    response = self.client.messages.create(
-                        model="claude-sonnet-4-20250514",
-                        max_tokens=4096,
-                        system="You should only answer queries related to exercises, workouts, and fitness. Do not answer any query not related to exercises.",
-                        messages=messages,
-                        tools=anthropic_tools
-                    )
-                
-                # Extract final text response
-                for block in response.content:
-                    if hasattr(block, "text") and block.text:
-                        final_text = block.text
-                        break
-                else:
-                    final_text = "No text response found"
-                
-                print("="*60)
-                print("CLAUDE'S ANSWER:")
-                print("="*60)
-                print(final_text)
-                print("="*60)
-                
-                return final_text
+        return final_text
     
     def search(self, query: str):
         """Synchronous wrapper for search_with_mcp"""
@@ -150,10 +272,25 @@ class GymandoTavilySearch:
 
 
 # Test it
+async def main():
+    # One Tavily MCP server + session serves every question in the loop
+    async with GymandoTavilySearch() as searcher:
+        # Reading input no longer blocks the loop, so the embedding model loads while the user types
+        warmup = asyncio.create_task(searcher._semantic_cache.warmup())
+        try:
+            while True:
+                user_input = await ainput("Give your question: ")
+                if user_input == "q":
+                    break
+                result = await searcher.search_with_mcp(user_input)
+        finally:
+            warmup.cancel()
+            await asyncio.gather(warmup, return_exceptions=True)
+
+
 if __name__ == "__main__":
-    searcher = GymandoTavilySearch()
-    while True:
-        user_input = input("Give your question: ")
-        if user_input == "q":
-            break
-        result = searcher.search(user_input)
+    logging.basicConfig(level=os.getenv("GYMMANDO_LOG", "WARNING"))
+    
+    install_uvloop()
+    
+    asyncio.run(main())
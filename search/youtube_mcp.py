@@ -4,11 +4,22 @@ Connects Claude AI with YouTube search via MCP
 """
 
 import os
+import sys
 import asyncio
+import logging
 from typing import List, Dict, Any, Optional
-from anthropic import Anthropic
-from mcp import ClientSession, StdioServerParameters
-from mcp.client.stdio import stdio_client
+from anthropic import AsyncAnthropic
+from mcp import StdioServerParameters
+
+from _cache import MCPSession, cached_create, partition, print_text
+from _http import get_async_anthropic, install_uvloop
+from semantic_cache import SemanticCache, tools_used
+
+logger = logging.getLogger("gymmando")
+
+
+# Output budget for the opening turn, which usually only selects tools
+TOOL_TURN_MAX_TOKENS = 1024
 
 
 class GymmandoYouTubeMCP:
@@ -40,10 +51,47 @@ class GymmandoYouTubeMCP:
         self.model = model
         self.max_tokens = max_tokens
         
-        self._session: Optional[ClientSession] = None
-        self._claude_client: Optional[Anthropic] = None
-        self._anthropic_tools: List[Dict[str, Any]] = []
+        self._mcp: Optional[MCPSession] = None
+        self._start_lock = asyncio.Lock()
+        self._semantic_cache = SemanticCache()
         
+    @property
+    def _claude_client(self) -> AsyncAnthropic:
+        """Shared Claude client for the running event loop."""
+        return get_async_anthropic(self.anthropic_api_key)
+    
+    async def __aenter__(self) -> "GymmandoYouTubeMCP":
+        await self.start()
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        await self.close()
+    
+    async def start(self) -> None:
+        """
+        Start the YouTube MCP server once.
+        
+        The MCP subprocess and initialized session are kept open so every
+        chat() call reuses them until close().
+        """
+        # The lock stops concurrent start() calls from each spawning their own server
+        async with self._start_lock:
+            if self._mcp is not None:
+                return
+            
+            # Start MCP server and create session
+            mcp = self._new_session()
+            await mcp.start()
+            logger.debug("✓ Connected to YouTube MCP")
+            
+            self._mcp = mcp
+    
+    async def close(self) -> None:
+        """Shut down the MCP session and server process."""
+        mcp, self._mcp = self._mcp, None
+        if mcp is not None:
+            await mcp.close()
+    
     def _validate_api_keys(self) -> None:
         """Validate that required API keys are present."""
         if not self.anthropic_api_key:
@@ -51,6 +99,17 @@ class GymmandoYouTubeMCP:
         if not self.youtube_api_key:
             raise ValueError("YOUTUBE_API_KEY is required")
     
+    def _new_session(self) -> MCPSession:
+        """
+        Create an unstarted MCP session for the YouTube server.
+        
+        Calls without a running session use one of these privately: it is
+        never stored on self, so concurrent callers can't reuse it or close it
+        under each other, and the task that opens it is the one that closes it.
+        """
+        self._validate_api_keys()
+        return MCPSession(self._create_server_params())
+    
     def _create_server_params(self) -> StdioServerParameters:
         """Create MCP server parameters for YouTube MCP."""
         return StdioServerParameters(
@@ -61,143 +120,279 @@ class GymmandoYouTubeMCP:
             }
         )
     
-    async def _initialize_mcp_session(self, session: ClientSession) -> None:
-        """Initialize the MCP session and load available tools."""
-        await session.initialize()
-        
-        # Get available tools from YouTube MCP
-        tools_response = await session.list_tools()
-        
-        print(f"✓ Connected to YouTube MCP")
-        print(f"✓ Available tools: {[tool.name for tool in tools_response.tools]}\n")
-        
-        # Convert MCP tools to Anthropic format
-        self._anthropic_tools = [
-            {
-                "name": tool.name,
-                "description": tool.description,
-                "input_schema": tool.inputSchema
-            }
-            for tool in tools_response.tools
-        ]
-    
-    def _initialize_claude_client(self) -> None:
-        """Initialize the Claude client."""
-        self._claude_client = Anthropic(api_key=self.anthropic_api_key)
-    
-    async def _handle_tool_use(
-        self,
-        tool_use_block: Any,
-        messages: List[Dict[str, Any]]
-    ) -> None:
+    async def _handle_tool_use(self, mcp: MCPSession, tool_use_block: Any) -> Dict[str, Any]:
         """
         Handle a tool use request from Claude.
         
         Args:
+            mcp: MCP session to call the tool on
             tool_use_block: The tool use block from Claude's response
-            messages: Current conversation messages list (modified in-place)
+            
+        Returns:
+            The tool_result content block to send back to Claude
         """
         tool_name = tool_use_block.name
         tool_input = tool_use_block.input
         
-        print(f"🔧 Claude is using tool: {tool_name}")
-        print(f"   Input: {tool_input}\n")
+        logger.debug("🔧 Claude is using tool: %s (input: %s)", tool_name, tool_input)
         
         # Call the MCP tool
-        tool_result = await self._session.call_tool(tool_name, tool_input)
+        tool_result = await mcp.call_tool(tool_name, tool_input)
         
-        print(f"✓ Tool result received\n")
+        logger.debug("✓ Tool result received")
         
-        # Add tool result to messages
-        # Note: Assistant response is already added in chat() method before this is called
-        messages.append({
-            "role": "user",
-            "content": [{
-                "type": "tool_result",
-                "tool_use_id": tool_use_block.id,
-                "content": tool_result.content
-            }]
-        })
+        return {
+            "type": "tool_result",
+            "tool_use_id": tool_use_block.id,
+            "content": tool_result
+        }
     
-    def _extract_final_text(self, response: Any) -> str:
+    def _extract_final_text(self, text_blocks: List[Any]) -> str:
         """
         Extract final text from Claude's response.
         
         Args:
-            response: Claude's response object
+            text_blocks: Text blocks of Claude's response
             
         Returns:
             The text content from the response
         """
-        for block in response.content:
-            if hasattr(block, "text") and block.text:
-                return block.text
-        return ""
+        return next((block.text for block in text_blocks if block.text), "")
     
-    async def chat(self, user_message: str) -> str:
+    async def chat(self, user_message: str, echo: bool = True) -> str:
         """
         Send a message to Claude that can use YouTube MCP for searching videos.
         
         Args:
             user_message: The user's message/query
+            echo: Print the exchange, streaming Claude's text as it arrives
             
         Returns:
             Claude's final response text
         """
-        self._validate_api_keys()
+        return await self._answer(user_message, echo, self._mcp)
+    
+    async def _answer(self, user_message: str, echo: bool, mcp: Optional[MCPSession]) -> str:
+        """Answer from the semantic cache, or chat over mcp (a private session if None)."""
+        if echo:
+            print(f"User: {user_message}\n")
         
-        # Create server parameters
-        server_params = self._create_server_params()
+        # Near-duplicate of an earlier message - answer without Claude or MCP
+        cached_answer = await self._semantic_cache.get(user_message)
+        if cached_answer is not None:
+            if echo:
+                print(f"Claude: {cached_answer}\n")
+            return cached_answer
         
-        # Start MCP server and create session
-        async with stdio_client(server_params) as (read, write):
-            async with ClientSession(read, write) as session:
-                self._session = session
-                
-                # Initialize MCP session
-                await self._initialize_mcp_session(session)
+        # Without a running session, open a private one just for this message
+        if mcp is None:
+            async with self._new_session() as mcp:
+                return await self._chat(user_message, echo, mcp)
+        return await self._chat(user_message, echo, mcp)
+    
+    async def _chat(self, user_message: str, echo: bool, mcp: MCPSession) -> str:
+        """Run a chat over an open MCP session and remember its answer."""
+        # Send message to Claude with MCP tools
+        messages = [{"role": "user", "content": user_message}]
+        final_text = await self._run_conversation(messages, mcp, echo=echo)
+        await self._semantic_cache.put(user_message, final_text, tools_used(messages))
+        return final_text
+    
+    async def chat_many(
+        self,
+        user_messages: List[str],
+        concurrency: int = 5
+    ) -> List[str]:
+        """
+        Run several independent chats concurrently over the shared MCP session.
+        
+        The MCP client session multiplexes requests by id, so the chats can
+        share it without a lock; the semaphore bounds requests in flight.
+        Output is not echoed, since concurrent streams would interleave.
+        
+        Args:
+            user_messages: The user's messages/queries
+            concurrency: Maximum number of chats running at once
+            
+        Returns:
+            Claude's final response text for each message, in order
+        """
+        # Without a running session, the chats share a private one opened just for them
+        if self._mcp is None:
+            async with self._new_session() as mcp:
+                return await self._chat_many(user_messages, concurrency, mcp)
+        return await self._chat_many(user_messages, concurrency, self._mcp)
+    
+    async def _chat_many(
+        self,
+        user_messages: List[str],
+        concurrency: int,
+        mcp: MCPSession
+    ) -> List[str]:
+        """Run the chats of chat_many() over an open MCP session."""
+        semaphore = asyncio.Semaphore(concurrency)
+        
+        async def run_one(user_message: str) -> str:
+            async with semaphore:
+                return await self._answer(user_message, False, mcp)
+        
+        return list(await asyncio.gather(*(run_one(m) for m in user_messages)))
+    
+    async def batch_chat(
+        self,
+        user_messages: List[str],
+        poll_interval: float = 5.0
+    ) -> List[str]:
+        """
+        Answer several independent messages, sending each first turn through
+        the Message Batches API (half the token price, but asynchronous).
+        
+        Tool use needs the live MCP session, so any conversation that comes
+        back with stop_reason == "tool_use" continues with normal round-trips.
+        
+        Args:
+            user_messages: The user's messages/queries
+            poll_interval: Seconds between batch status checks
+            
+        Returns:
+            Claude's final response text for each message, in order
+        """
+        # Without a running session, open a private one just for this batch
+        if self._mcp is None:
+            async with self._new_session() as mcp:
+                return await self._batch_chat(user_messages, poll_interval, mcp)
+        return await self._batch_chat(user_messages, poll_interval, self._mcp)
+    
+    async def _batch_chat(
+        self,
+        user_messages: List[str],
+        poll_interval: float,
+        mcp: MCPSession
+    ) -> List[str]:
+        """Run batch_chat() over an open MCP session."""
+        batch = await self._claude_client.messages.batches.create(
+            requests=[
+                {
+                    "custom_id": f"q{i}",
+                    "params": {
+                        "model": self.model,
+                        "max_tokens": self.max_tokens,
+                        "messages": [{"role": "user", "content": user_message}],
+                        "tools": mcp.tools
+                    }
+                }
+                for i, user_message in enumerate(user_messages)
+            ]
+        )
+        logger.info("📦 Submitted batch %s (%d requests)", batch.id, len(user_messages))
+        
+        while batch.processing_status != "ended":
+            await asyncio.sleep(poll_interval)
+            batch = await self._claude_client.messages.batches.retrieve(batch.id)
+        
+        first_responses = {}
+        async for entry in await self._claude_client.messages.batches.results(batch.id):
+            if entry.result.type == "succeeded":
+                first_responses[entry.custom_id] = entry.result.message
+        
+        answers = []
+        for i, user_message in enumerate(user_messages):
+            print(f"User: {user_message}\n")
+            messages = [{"role": "user", "content": user_message}]
+            # Errored or expired batch requests are retried as a normal round-trip
+            answers.append(
+                await self._run_conversation(messages, mcp, first_responses.get(f"q{i}"))
+            )
+        return answers
+    
+    async def _run_conversation(
+        self,
+        messages: List[Dict[str, Any]],
+        mcp: MCPSession,
+        response: Optional[Any] = None,
+        echo: bool = True
+    ) -> str:
+        """
+        Run the tool-use loop until Claude gives a final answer.
+        
+        Args:
+            messages: Current conversation messages list (modified in-place)
+            mcp: MCP session the conversation's tools run on
+            response: Claude's reply to messages if it was already fetched
+            echo: Stream Claude's text to the console as it arrives
+            
+        Returns:
+            Claude's final response text
+        """
+        on_text = print_text if echo else None
+        # A reply fetched up front (e.g. from a batch) was already generated with the full budget
+        if response is None:
+            max_tokens = min(TOOL_TURN_MAX_TOKENS, self.max_tokens)
+        else:
+            max_tokens = self.max_tokens
+        
+        if echo:
+            print("Claude: ", end="")
+            
+            # A reply fetched up front (e.g. from a batch) is echoed in one go
+            if response is not None:
+                for block in response.content:
+                    if block.type == "text":
+                        print_text(block.text)
+        
+        # Conversation loop to handle tool calls
+        while True:
+            if response is None:
+                # Full-budget turns stream their text as it arrives when echoing; the
+                # tool-selection turn doesn't, so a truncated reply is never shown
+                tool_turn = max_tokens < self.max_tokens
+                response = await cached_create(
+                    self._claude_client,
+                    on_text=None if tool_turn else on_text,
+                    model=self.model,
+                    max_tokens=max_tokens,
+                    messages=messages,
+                    tools=mcp.tools
+                )
                 
-                # Initialize Claude client
-                self._initialize_claude_client()
+                if tool_turn and response.stop_reason == "max_tokens":
+                    # Claude answered directly and outgrew the tool-selection budget - regenerate in full
+                    max_tokens = self.max_tokens
+                    response = None
+                    continue
                 
-                # Send message to Claude with MCP tools
-                print(f"User: {user_message}\n")
+                if tool_turn and echo:
+                    for block in response.content:
+                        if block.type == "text":
+                            print_text(block.text)
+            
+            if echo:
+                print("\n")
+            
+            text_blocks, tool_use_blocks = partition(response.content)
+            
+            # Check if Claude wants to use a tool
+            if response.stop_reason == "tool_use":
+                # Store the assistant's response before handling tools
+                messages.append({
+                    "role": "assistant",
+                    "content": response.content
+                })
                 
-                messages = [{"role": "user", "content": user_message}]
+                # Every tool_use block needs its tool_result in the next user turn
+                tool_results = []
+                for tool_use_block in tool_use_blocks:
+                    tool_results.append(await self._handle_tool_use(mcp, tool_use_block))
+                messages.append({"role": "user", "content": tool_results})
                 
-                # Conversation loop to handle tool calls
-                while True:
-                    response = self._claude_client.messages.create(
-                        model=self.model,
-                        max_tokens=self.max_tokens,
-                        messages=messages,
-                        tools=self._anthropic_tools
-                    )
-                    
-                    # Check if Claude wants to use a tool
-                    if response.stop_reason == "tool_use":
-                        # Extract tool use from response
-                        tool_use_block = next(
-                            block for block in response.content 
-                            if block.type == "tool_use"
-                        )
-                        
-                        # Store the assistant's response before handling tool
-                        messages.append({
-                            "role": "assistant",
-                            "content": response.content
-                        })
-                        
-                        await self._handle_tool_use(tool_use_block, messages)
-                        
-                        # Continue loop to get Claude's final response
-                        continue
-                    
-                    else:
-                        # Claude has finished, print final response
-                        final_text = self._extract_final_text(response)
-                        print(f"Claude: {final_text}\n")
-                        return final_text
+                # Continue loop to get Claude's final response with the full budget
+                max_tokens = self.max_tokens
+                response = None
+                continue
+            
+            else:
+                # Claude has finished; its final response was streamed above
+                return self._extract_final_text(text_blocks)
 
 
 async def main():
@@ -218,10 +413,7 @@ async def main():
         print("❌ YOUTUBE_API_KEY not found in environment")
         return
     
-    print("✓ API keys loaded\n")
-    
-    # Create Gymmando client instance
-    client = GymmandoYouTubeMCP()
+    logger.debug("✓ API keys loaded")
     
     # Test queries
     test_queries = [
@@ -230,13 +422,18 @@ async def main():
         "Show me the best squat technique videos"
     ]
     
-    # Run first test query
-    await client.chat(test_queries[0])
-    
-    # Uncomment to test more queries:
-    # for query in test_queries:
-    #     await client.chat(query)
-    #     print("\n" + "-"*60 + "\n")
+    # Create Gymmando client instance; one MCP session serves every query
+    async with GymmandoYouTubeMCP() as client:
+        if "--batch" in sys.argv:
+            # Evaluation runs: first turns go through the Batches API at half the price
+            await client.batch_chat(test_queries)
+        else:
+            # The test queries are independent, so run them concurrently
+            answers = await client.chat_many(test_queries)
+            for query, answer in zip(test_queries, answers):
+                print(f"User: {query}\n")
+                print(f"Claude: {answer}\n")
+                print("-"*60 + "\n")
 
 
 if __name__ == "__main__":
@@ -244,5 +441,9 @@ if __name__ == "__main__":
     from dotenv import load_dotenv
     load_dotenv()
     
+    logging.basicConfig(level=os.getenv("GYMMANDO_LOG", "WARNING"))
+    
+    install_uvloop()
+    
     # Run async main
     asyncio.run(main())
\ No newline at end of file